@@ -0,0 +1,5 @@
+cimport cython
+
+
+@cython.locals(parts=list, message_text=str, capcodes=list)
+cpdef dict parse_flex_line(str line)
@@ -0,0 +1,68 @@
+"""FLEX line parser.
+
+Plain Python, but written to be compiled with Cython for the hot path:
+
+    cythonize -3 -i flexparse.py
+
+flexparse.pxd adds the C types. The built extension takes precedence on
+import; without it this module is used as-is.
+"""
+import itertools
+import re
+import time
+import uuid
+
+# Message field patterns, matched in a single pass
+FIELDS_RE = re.compile(
+    r'\b(?P<prio>A[1-2]|B1|P[1-3]|PRIO\s?[1-5])\b|\bGRIP\s?(?P<grip>[1-4])\b',
+    re.I
+)
+
+# Message ids: a random per-run prefix plus a counter, so ids stay unique
+# across restarts without reading os.urandom for every message
+RUN_PREFIX = uuid.uuid4().hex[:12]
+message_counter = itertools.count()
+
+
+def parse_flex_line(line):
+    """Parse FLEX output into structured JSON."""
+    # Only the first five separators matter; the tail is the message text
+    # (type field included) and is kept whole instead of split and rejoined
+    parts = line.split('|', 5)
+
+    if len(parts) < 6 or '|' not in parts[5]:
+        message_text = line
+        capcodes = []
+        timestamp_raw = None
+        prio = None
+        grip = None
+    else:
+        timestamp_raw = parts[1]
+        message_text = parts[5].strip()
+        capcodes = parts[4].split()  # [] for an empty or blank field
+
+        prio = None
+        grip = None
+        for m in FIELDS_RE.finditer(message_text):
+            if m.lastgroup == 'prio':
+                if prio is None:
+                    prio = m.group('prio')
+            elif grip is None:
+                grip = f"GRIP {m.group('grip')}"
+
+            if prio is not None and grip is not None:
+                break
+
+    return {
+        "id": f"{RUN_PREFIX}-{next(message_counter):08x}",
+        "protocol": "FLEX",
+        "timestamp_unix": int(time.time()),
+        "raw_flex_timestamp": timestamp_raw,
+        "raw": line,
+        "data": {
+            "message": message_text,
+            "prio": prio,
+            "grip": grip,
+            "capcodes": capcodes
+        }
+    }
@@ -4,42 +4,149 @@ import pika
 import sys
 import time
 import json
-import re
-import uuid
 import os
 import signal
+import fcntl
+import select
+import threading
+import queue
 from datetime import datetime, timezone
 
+from pika.adapters.select_connection import IOLoop
+
+from flexparse import parse_flex_line
+
+try:
+    from orjson import dumps as json_dumps
+except ImportError:
+    # Stdlib fallback; orjson serializes straight to bytes and is much faster
+    def json_dumps(obj):
+        return json.dumps(obj).encode("utf8")
+
 # RabbitMQ settings
 RABBITMQ_HOST = "vps.caelyn.nl"
 RABBITMQ_USER = "p2000"
 RABBITMQ_PASS = "Pi2000"
 RABBITMQ_QUEUE = "p2000"
 
+# Socket options for the broker connection. pika already sets TCP_NODELAY
+# and the AMQP heartbeat keeps the link warm; this makes a publish stuck on
+# a dead link fail after 30 s instead of waiting out TCP retransmissions.
+RABBITMQ_TCP_OPTIONS = {'TCP_USER_TIMEOUT': 30000}
+
+# Properties for every published message; never modified, so shared.
+# Messages are transient: with a 5 minute TTL, persisting each one to disk
+# buys little, and confirms still report anything the broker did not take.
+MESSAGE_PROPERTIES = pika.BasicProperties(delivery_mode=1)
+
 # SDR settings
 FREQUENCY = "169.65M"
 
+# Requested size of the multimon-ng output pipe (Linux default is 64 KiB),
+# to absorb bursts while the reader is busy
+PIPE_SIZE = 1 << 20
+
+# Publish batching: up to BATCH_SIZE lines, or whatever arrived within
+# BATCH_WINDOW seconds of the first one
+BATCH_SIZE = 32
+BATCH_WINDOW = 0.05
+
+# Parsed messages waiting for the publisher; the oldest are dropped when full
+PUBLISH_QUEUE_SIZE = 1024
+
 # Logging
 LOG_DIR = "/var/log/p2000"
 LOG_FILE = f"{LOG_DIR}/p2000.log"
+LOG_FLUSH_LINES = 32
+LOG_FLUSH_INTERVAL = 0.1
+
+# Echo every received message to stdout (DEBUG=1 in the environment);
+# they always go to the log file
+DEBUG = bool(os.environ.get("DEBUG"))
 
 # Graceful shutdown flag
 running = True
 
+# Log file handle, opened once by open_log()
+log_fh = None
+log_lock = threading.RLock()
+log_pending = 0
+reopen_log = False
+
+
+def open_log():
+    """(Re)open the log file; kept open so log() does not reopen it per line."""
+    global log_fh, log_pending
+
+    with log_lock:
+        if log_fh is not None:
+            try:
+                log_fh.close()
+            except Exception:
+                pass
+
+        try:
+            log_fh = open(LOG_FILE, "a", buffering=8192)
+        except Exception:
+            log_fh = None
+
+        log_pending = 0
+
+
+def log(msg, echo=True):
+    """Log msg to the log file, and to stdout (journald) if echo is set."""
+    global reopen_log, log_pending
 
-def log(msg):
     timestamp = datetime.now(timezone.utc).isoformat()
-    line = f"{timestamp} | {msg}"
+    line = f"{timestamp} | {msg}\n"
 
-    # Print to journald (stdout)
-    print(line, flush=True)
+    # Reopen after logrotate sent SIGHUP
+    if reopen_log:
+        reopen_log = False
+        open_log()
 
-    # Append to file
-    try:
-        with open(LOG_FILE, "a") as f:
-            f.write(line + "\n")
-    except Exception:
-        pass
+    with log_lock:
+        # Write to journald (stdout); flush_log_output() flushes it
+        if echo:
+            try:
+                sys.stdout.buffer.write(line.encode())
+            except Exception:
+                pass
+
+        # Append to file, flushing every LOG_FLUSH_LINES lines
+        if log_fh is None:
+            return
+
+        try:
+            log_fh.write(line)
+
+            log_pending += 1
+            if log_pending >= LOG_FLUSH_LINES:
+                log_fh.flush()
+                log_pending = 0
+        except Exception:
+            pass
+
+
+def flush_log_output():
+    """Flush buffered stdout and the log file every LOG_FLUSH_INTERVAL seconds."""
+    global log_pending
+
+    while True:
+        time.sleep(LOG_FLUSH_INTERVAL)
+
+        with log_lock:
+            try:
+                sys.stdout.buffer.flush()
+            except Exception:
+                pass
+
+            if log_fh is not None and log_pending:
+                try:
+                    log_fh.flush()
+                    log_pending = 0
+                except Exception:
+                    pass
 
 
 def handle_signal(signum, frame):
@@ -48,9 +155,16 @@ def handle_signal(signum, frame):
     log(f"Received signal {signum}, shutting down...")
 
 
+def handle_sighup(signum, frame):
+    global reopen_log
+    reopen_log = True
+
+
 for s in (signal.SIGINT, signal.SIGTERM):
     signal.signal(s, handle_signal)
 
+signal.signal(signal.SIGHUP, handle_sighup)
+
 
 def start_decoder():
     """Start rtl_fm + multimon-ng."""
@@ -82,123 +196,321 @@ def start_decoder():
         multi_cmd,
         stdin=rtl.stdout,
         stdout=subprocess.PIPE,
-        stderr=subprocess.DEVNULL,
-        text=True
+        stderr=subprocess.DEVNULL
     )
 
+    try:
+        fcntl.fcntl(multi.stdout.fileno(), getattr(fcntl, "F_SETPIPE_SZ", 1031), PIPE_SIZE)
+    except OSError as e:
+        log(f"Could not resize decoder pipe: {e}")
+
     return rtl, multi
 
 
-def connect_rabbit():
-    credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS)
+class Publisher:
+    """Publish to RabbitMQ from a SelectConnection IO loop with async confirms.
+
+    The IO loop runs on its own thread; publish() only enqueues parsed
+    messages on a bounded queue, and the loop serializes and publishes them
+    in batches of BATCH_SIZE. Basic.Ack/Nack frames are handled as they
+    arrive, so there is no round-trip per message on the decoder path.
+    Lost connections are re-established from the IO loop, so the decoder
+    keeps running while RabbitMQ is unreachable; messages wait in the queue
+    meanwhile.
+    """
+
+    def __init__(self):
+        self.ioloop = IOLoop()
+        self.queue = queue.Queue(maxsize=PUBLISH_QUEUE_SIZE)
+        self.conn = None
+        self.ch = None
+        self.thread = None
+        self.stopping = False
+        self.ready = threading.Event()
+        self.closed = threading.Event()
+        self.next_tag = 1
+        self.unacked = {}
+
+    def start(self):
+        self.ioloop.add_callback_threadsafe(self._connect)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def publish(self, msgs):
+        """Queue parsed messages and wake the IO loop to publish them."""
+        dropped = 0
+        for msg in msgs:
+            try:
+                self.queue.put_nowait(msg)
+            except queue.Full:
+                # Keep the most recent messages
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    pass
+                self.queue.put_nowait(msg)
+                dropped += 1
 
-    while running:
+        if dropped:
+            log(f"Publish queue full, dropped {dropped} oldest messages")
+
+        self.ioloop.add_callback_threadsafe(self._drain)
+
+    def close(self):
+        if not self.closed.is_set():
+            self.ioloop.add_callback_threadsafe(self._stop)
+        self.thread.join(timeout=5)
+
+    def _run(self):
+        try:
+            self.ioloop.start()
+        finally:
+            self.closed.set()
+
+    # --- IO loop callbacks ---
+
+    def _connect(self):
+        if self.stopping:
+            return
+
+        log("Connecting to RabbitMQ...")
+        credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS)
+        self.conn = pika.SelectConnection(
+            pika.ConnectionParameters(
+                host=RABBITMQ_HOST,
+                credentials=credentials,
+                heartbeat=30,
+                tcp_options=RABBITMQ_TCP_OPTIONS
+            ),
+            on_open_callback=self._on_connection_open,
+            on_open_error_callback=self._on_connection_error,
+            on_close_callback=self._on_connection_closed,
+            custom_ioloop=self.ioloop
+        )
+
+    def _reconnect(self):
+        self.ready.clear()
+        self.ch = None
+        self.next_tag = 1
+        self.unacked = {}
+
+        if self.stopping:
+            self.ioloop.stop()
+        else:
+            self.ioloop.call_later(5, self._connect)
+
+    def _on_connection_open(self, conn):
+        conn.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_error(self, conn, err):
+        log(f"RabbitMQ connection failed: {err}")
+        self._reconnect()
+
+    def _on_connection_closed(self, conn, reason):
+        if self.unacked:
+            log(f"{len(self.unacked)} messages unconfirmed at disconnect")
+        log(f"RabbitMQ connection closed: {reason}")
+        self._reconnect()
+
+    def _on_channel_open(self, ch):
+        self.ch = ch
+        ch.add_on_close_callback(self._on_channel_closed)
+        ch.add_on_return_callback(self._on_return)
+        ch.queue_declare(
+            queue=RABBITMQ_QUEUE,
+            durable=True,
+            arguments={'x-message-ttl': 300000},
+            callback=self._on_queue_declared
+        )
+
+    def _on_channel_closed(self, ch, reason):
+        log(f"RabbitMQ channel closed: {reason}")
+        self.ready.clear()
+        self._close()
+
+    def _on_queue_declared(self, frame):
+        self.ch.confirm_delivery(
+            ack_nack_callback=self._on_confirm,
+            callback=self._on_confirm_selected
+        )
+
+    def _on_confirm_selected(self, frame):
+        log("RabbitMQ connected.")
+        self.ready.set()
+        self._drain()
+
+    def _on_confirm(self, frame):
+        method = frame.method
+        if method.multiple:
+            tags = [t for t in self.unacked if t <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag]
+
+        bodies = [self.unacked.pop(t) for t in tags if t in self.unacked]
+
+        if isinstance(method, pika.spec.Basic.Nack):
+            log(f"Broker nacked {len(bodies)} messages, republishing")
+            self._publish(bodies)
+
+    def _on_return(self, ch, method, properties, body):
+        log(f"Message returned by broker: {method.reply_text}")
+
+    def _drain(self):
+        """Publish up to BATCH_SIZE queued messages, then yield to the loop."""
+        if not self.ready.is_set() or not self.ch.is_open:
+            return  # picked up again once reconnected
+
+        batch = []
         try:
-            log("Connecting to RabbitMQ...")
-            conn = pika.BlockingConnection(
-                pika.ConnectionParameters(
-                    host=RABBITMQ_HOST,
-                    credentials=credentials,
-                    heartbeat=30
+            while len(batch) < BATCH_SIZE:
+                batch.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+
+        if not batch:
+            return
+
+        bodies = [json_dumps(msg) for msg in batch]
+
+        for body in bodies:
+            log(f"RX {body.decode()}", echo=DEBUG)
+
+        self._publish(bodies)
+
+        if len(batch) == BATCH_SIZE:
+            self.ioloop.call_later(0, self._drain)
+
+    def _publish(self, bodies):
+        if not self.ready.is_set() or not self.ch.is_open:
+            log(f"RabbitMQ not connected, dropped {len(bodies)} messages")
+            return
+
+        for i, body in enumerate(bodies):
+            try:
+                self.ch.basic_publish(
+                    exchange='',
+                    routing_key=RABBITMQ_QUEUE,
+                    body=body,
+                    properties=MESSAGE_PROPERTIES,
+                    mandatory=True
                 )
-            )
-            ch = conn.channel()
-            ch.queue_declare(
-                queue=RABBITMQ_QUEUE,
-                durable=True,
-                arguments={'x-message-ttl': 300000}
-            )
-            log("RabbitMQ connected.")
-            return conn, ch
-        except Exception as e:
-            log(f"RabbitMQ connection failed: {e}")
-            time.sleep(5)
-
-    return None, None
-
-
-def parse_flex_line(line):
-    """Parse FLEX output into structured JSON."""
-    parts = line.split('|')
-
-    if len(parts) < 7:
-        message_text = line
-        capcodes = []
-        timestamp_raw = None
-        prio = None
-        grip = None
-    else:
-        timestamp_raw = parts[1]
-        message_text = '|'.join(parts[5:]).strip()
-        capcodes = parts[4].split() if parts[4].strip() else []
-
-        prio_match = re.search(r'\b(A[1-2]|B1|P[1-3]|PRIO\s?[1-5])\b', message_text, re.I)
-        prio = prio_match.group(0) if prio_match else None
-
-        grip_match = re.search(r'\bGRIP\s?([1-4])\b', message_text, re.I)
-        grip = f"GRIP {grip_match.group(1)}" if grip_match else None
-
-    now = datetime.now(timezone.utc)
-
-    return {
-        "id": str(uuid.uuid4()),
-        "protocol": "FLEX",
-        "timestamp_unix": int(now.timestamp()),
-        "timestamp_iso": now.isoformat(),
-        "raw_flex_timestamp": timestamp_raw,
-        "raw": line,
-        "data": {
-            "message": message_text,
-            "prio": prio,
-            "grip": grip,
-            "capcodes": capcodes
-        }
-    }
+            except Exception as e:
+                log(f"Publish failed, dropped {len(bodies) - i} messages: {e}")
+                self.ready.clear()
+                self._close()
+                return
+
+            self.unacked[self.next_tag] = body
+            self.next_tag += 1
+
+    def _close(self):
+        if self.conn is not None and not (self.conn.is_closing or self.conn.is_closed):
+            self.conn.close()
+
+    def _stop(self):
+        self.stopping = True
+
+        if self.conn is not None and not (self.conn.is_closing or self.conn.is_closed):
+            self.conn.close()  # _reconnect() stops the loop once closed
+        else:
+            self.ioloop.stop()
+
+
+def connect_rabbit():
+    """Start the publisher and wait until it first reaches the broker."""
+    publisher = Publisher()
+    publisher.start()
+
+    while running and not publisher.ready.is_set():
+        publisher.ready.wait(0.1)
+
+    return publisher
+
+
+class LineReader:
+    """Split the decoder output into lines using raw os.read() calls."""
+
+    def __init__(self, stdout):
+        self.fd = stdout.fileno()
+        self.pending = bytearray()
+        self.eof = False
+
+    def read_batch(self):
+        """Read lines, waiting at most BATCH_WINDOW after the first one.
+
+        Lines come back stripped, with blank lines and the multimon-ng banner
+        left out. Stops waiting once BATCH_SIZE lines are in hand. Returns an
+        empty list if nothing arrived and None once the decoder closed its
+        output.
+        """
+        if self.eof:
+            return None
+
+        lines = []
+        deadline = None
+
+        while len(lines) < BATCH_SIZE:
+            timeout = BATCH_WINDOW if deadline is None else deadline - time.monotonic()
+            if timeout <= 0 or not select.select([self.fd], [], [], timeout)[0]:
+                break
+
+            data = os.read(self.fd, 65536)
+            if not data:
+                # Keep a final line that has no trailing newline
+                self.eof = True
+                self._add_lines(lines, [self.pending])
+                self.pending = bytearray()
+                return lines or None
+
+            self.pending += data
+            chunks = self.pending.split(b"\n")
+            self.pending = chunks.pop()
+            self._add_lines(lines, chunks)
+
+            if deadline is None and lines:
+                deadline = time.monotonic() + BATCH_WINDOW
+
+        return lines
+
+    def _add_lines(self, lines, chunks):
+        for raw in chunks:
+            # Strip and filter the bytes, so only lines worth parsing are
+            # decoded; multimon-ng repeats its banner on every start
+            raw = raw.strip()
+            if not raw or raw.startswith(b"Enabled demodulators:"):
+                continue
+
+            # Decode per line, not per character as a text-mode pipe would
+            lines.append(raw.decode("utf-8", "replace"))
 
 
 def main():
     # Ensure log directory exists
     os.makedirs(LOG_DIR, exist_ok=True)
+    open_log()
+    threading.Thread(target=flush_log_output, daemon=True).start()
 
     fail_counter = 0
 
-    while running:
-        conn, ch = connect_rabbit()
-        if not conn:
-            break
+    publisher = connect_rabbit()
 
+    while running:
         rtl_proc, multi_proc = start_decoder()
 
         log("Decoder running. Waiting for messages...")
 
+        reader = LineReader(multi_proc.stdout)
+
         try:
             while running:
-                line = multi_proc.stdout.readline()
-
-                if not line:
-                    # No data — FLEX is bursty; wait and continue
-                    time.sleep(0.1)
-                    continue
-
-                line = line.strip()
-                if not line or line.startswith("Enabled demodulators:"):
-                    continue
-
-                msg = parse_flex_line(line)
-                msg_json = json.dumps(msg)
+                lines = reader.read_batch()
 
-                log(f"RX {msg_json}")
+                if lines is None:
+                    log("Decoder exited.")
+                    break
 
-                try:
-                    ch.basic_publish(
-                        exchange='',
-                        routing_key=RABBITMQ_QUEUE,
-                        body=msg_json.encode("utf8"),
-                        properties=pika.BasicProperties(delivery_mode=2)
-                    )
-                except Exception as e:
-                    log(f"Publish failed: {e}")
-                    break  # reconnect
+                if lines:
+                    publisher.publish([parse_flex_line(line) for line in lines])
 
         except Exception as e:
             log(f"Decoder loop error: {e}")
@@ -211,16 +523,20 @@ def main():
             if multi_proc.poll() is None:
                 multi_proc.kill()
 
-            if conn.is_open:
-                conn.close()
-
             # Backoff if crashing repeatedly
             sleep_time = min(30, fail_counter * 3)
             log(f"Restarting decoder in {sleep_time} seconds...")
             time.sleep(sleep_time)
 
+    publisher.close()
+
     log("Service stopped.")
 
+    sys.stdout.buffer.flush()
+
+    if log_fh is not None:
+        log_fh.close()
+
 
 if __name__ == "__main__":
     main()